@@ -1,13 +1,24 @@
 # bot.py
 import os
-import re
+import sys
 import time
+import asyncio
+import string
 import logging
-from functools import wraps
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+import ahocorasick
+import redis.asyncio as aioredis
 from dotenv import load_dotenv
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
 from telegram import (
-    Update, InlineKeyboardMarkup, InlineKeyboardButton, ChatPermissions, ChatMember
+    Update, InlineKeyboardMarkup, InlineKeyboardButton, ChatPermissions, ChatMember,
+    MessageEntity
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes,
@@ -16,15 +27,16 @@ from telegram.ext import (
 
 # local db helper (Mongo)
 from db import (
-    get_warn_count, set_warn_count, reset_warn,
-    add_filter, remove_filter, get_filters,
-    get_setting, set_setting, log_action
+    increment_warn, reset_warn,
+    add_filter, add_filters_bulk, remove_filter, get_filters,
+    get_settings, log_action, init_db, run_log_flusher, flush_logs,
+    watch_cache_invalidations, close_db
 )
 
 # Load env
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = {int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+ADMIN_IDS = frozenset(int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
 WARN_LIMIT = int(os.getenv("WARN_LIMIT", "3"))
 FLOOD_LIMIT = int(os.getenv("FLOOD_LIMIT", "5"))
 CAPTCHA_TIMEOUT = int(os.getenv("CAPTCHA_TIMEOUT", "60"))
@@ -32,6 +44,8 @@ WELCOME_TEXT = os.getenv("WELCOME_TEXT", "Welcome! Please verify using the butto
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").lower() in ("true", "1")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+PORT = int(os.getenv("PORT", "8443"))
+REDIS_URL = os.getenv("REDIS_URL", "")
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN env var is required")
@@ -41,37 +55,113 @@ logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s - %(levelname)s - %(mes
 logger = logging.getLogger(__name__)
 
 # Moderation constants
-URL_REGEX = re.compile(r"(https?://\S+|\bwww\.\S+)", re.IGNORECASE)
-DEFAULT_BADWORDS = ["spamword1", "scam", "porn", "sex", "casino", "fake"]
-
-# In-memory flood tracker (for production use Redis)
-_flood_cache = {}  # {(chat_id,user_id): [timestamps]}
-
-def check_flood(chat_id, user_id, limit):
-    key = (int(chat_id), int(user_id))
+DEFAULT_BADWORDS = ("spamword1", "scam", "porn", "sex", "casino", "fake")
+# Telegram already marks links server-side; no need to regex the text
+LINK_ENTITIES = (MessageEntity.URL, MessageEntity.TEXT_LINK)
+_DEL_UPPER = str.maketrans("", "", string.ascii_uppercase)
+
+# One Aho-Corasick automaton per distinct filter list: a message is scanned
+# once no matter how many words a chat has banned. Keys are case-folded to
+# match the case-folded message text.
+@lru_cache(maxsize=1024)
+def badword_automaton(words):
+    automaton = ahocorasick.Automaton()
+    for w in words:
+        if w:
+            automaton.add_word(w.casefold(), w)
+    if len(automaton) == 0:
+        return None
+    automaton.make_automaton()
+    return automaton
+
+def has_link(msg):
+    return any(e.type in LINK_ENTITIES for e in (msg.entities or msg.caption_entities or ()))
+
+def count_upper(text):
+    # str.translate runs in C; only non-ASCII text needs Unicode isupper()
+    if text.isascii():
+        return len(text) - len(text.translate(_DEL_UPPER))
+    return sum(1 for c in text if c.isupper())
+
+# Flood tracker: in-memory per process, or a Redis sorted set per user when
+# REDIS_URL is set so several workers share one sliding window.
+FLOOD_WINDOW = 7  # seconds
+_flood_cache = {}  # {(chat_id,user_id): deque of timestamps}
+# Short timeouts: updates are handled one at a time, so a Redis that drops
+# packets must not hold up the bot for the OS TCP timeout.
+REDIS_TIMEOUT = 0.5  # seconds
+# After a failure, skip Redis for this long instead of retrying per message
+REDIS_RETRY_AFTER = 30  # seconds
+_redis = aioredis.Redis.from_url(
+    REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT
+) if REDIS_URL else None
+_redis_down_until = 0.0
+
+async def check_flood(chat_id, user_id, limit):
+    global _redis_down_until
+    if _redis is not None and time.monotonic() >= _redis_down_until:
+        try:
+            result = await _check_flood_redis(chat_id, user_id, limit)
+        except Exception as e:
+            # logged once per outage window, not once per message
+            if not _redis_down_until:
+                logger.warning("Redis flood check failed (%s), using local tracker", e)
+            _redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+        else:
+            if _redis_down_until:
+                logger.info("Redis flood check recovered")
+                _redis_down_until = 0.0
+            return result
+    return _check_flood_local(chat_id, user_id, limit)
+
+async def _check_flood_redis(chat_id, user_id, limit):
+    key = f"fl:{chat_id}:{user_id}"
+    now = time.time()
+    pipe = _redis.pipeline(transaction=True)
+    pipe.zremrangebyscore(key, "-inf", now - FLOOD_WINDOW)
+    pipe.zadd(key, {str(now): now})
+    pipe.zcard(key)
+    pipe.expire(key, FLOOD_WINDOW + 3)
+    _, _, count, _ = await pipe.execute()
+    return count > limit
+
+def _check_flood_local(chat_id, user_id, limit):
+    key = (chat_id, user_id)
     now = time.time()
-    hits = _flood_cache.get(key, [])
+    maxlen = max(limit, 0) + 1
+    hits = _flood_cache.get(key)
+    if hits is None or hits.maxlen != maxlen:
+        hits = _flood_cache[key] = deque(hits or (), maxlen=maxlen)
     # keep only hits in last 7 seconds window
-    hits = [t for t in hits if now - t < 7]
+    while hits and now - hits[0] >= FLOOD_WINDOW:
+        hits.popleft()
     hits.append(now)
-    _flood_cache[key] = hits
     return len(hits) > limit
 
-# Admin decorator (works for commands)
-def admin_only(func):
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user = update.effective_user
-        if user and (user.id in ADMIN_IDS):
-            return await func(update, context)
-        else:
-            try:
-                if update.effective_message:
-                    await update.effective_message.reply_text("❌ You are not authorized for this command.")
-            except Exception:
-                pass
-            return
-    return wrapper
+# Periodic job: sampled eviction of idle trackers (Redis-style). Each run
+# looks at a bounded slice from the front of the dict and moves survivors
+# to the back, so successive runs cycle through all entries.
+FLOOD_IDLE_TTL = 60  # seconds
+FLOOD_SWEEP_SAMPLE = 1024
+FLOOD_CACHE_MAX = 100000
+
+async def flood_sweep(context: ContextTypes.DEFAULT_TYPE):
+    now = time.time()
+    for key in list(islice(_flood_cache, FLOOD_SWEEP_SAMPLE)):
+        hits = _flood_cache.pop(key)
+        if hits and now - hits[-1] < FLOOD_IDLE_TTL:
+            _flood_cache[key] = hits
+    # hard cap: drop the entries that have gone longest without a sweep
+    overflow = len(_flood_cache) - FLOOD_CACHE_MAX
+    if overflow > 0:
+        for key in list(islice(_flood_cache, overflow)):
+            del _flood_cache[key]
+
+# Admin commands are only dispatched for these users; anyone else's
+# /warn etc. never reaches the handler.
+ADMIN_FILTER = filters.User(user_id=ADMIN_IDS)
+# Updates worth moderating: text or captions from non-admins
+MODERATED_MESSAGES = (filters.TEXT | filters.CAPTION) & ~filters.StatusUpdate.ALL & ~ADMIN_FILTER
 
 # Commands
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -80,7 +170,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
         "Admin commands:\n"
-        "/addfilter <word> - add banned word\n"
+        "/addfilter <word>[, <word>...] - add banned word(s)\n"
         "/delfilter <word> - remove\n"
         "/listfilters - show\n"
         "/warn (reply) - warn user\n"
@@ -149,14 +239,10 @@ async def captcha_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Warn helper
 async def warn_user(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, reason: str = ""):
     try:
-        current = get_warn_count(chat_id, user_id) or 0
-    except Exception:
-        current = 0
-    count = current + 1
-    try:
-        set_warn_count(chat_id, user_id, count)
+        count = await increment_warn(chat_id, user_id)
     except Exception:
-        logger.exception("Failed to set warn count")
+        logger.exception("Failed to increment warn count")
+        count = 1
     try:
         await context.bot.send_message(chat_id=chat_id, text=f"⚠️ <a href='tg://user?id={user_id}'>User</a> warned ({count}/{WARN_LIMIT}). Reason: {reason}", parse_mode="HTML")
     except Exception:
@@ -173,10 +259,27 @@ async def warn_user(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: i
         except Exception:
             logger.exception("Could not mute user.")
         try:
-            reset_warn(chat_id, user_id)
+            await reset_warn(chat_id, user_id)
         except Exception:
             logger.exception("Could not reset warns after mute")
 
+# Flood deletions are collected for a short window per user, then removed
+# with one deleteMessages call and a single warning.
+FLOOD_DELETE_DELAY = 0.2  # seconds
+DELETE_MESSAGES_MAX = 100  # Bot API limit per deleteMessages call
+_flood_pending = {}  # {(chat_id,user_id): [message_ids]}
+
+async def flush_flood(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
+    await asyncio.sleep(FLOOD_DELETE_DELAY)
+    ids = _flood_pending.pop((chat_id, user_id), [])
+    for i in range(0, len(ids), DELETE_MESSAGES_MAX):
+        try:
+            await context.bot.delete_messages(chat_id, ids[i:i + DELETE_MESSAGES_MAX])
+        except Exception:
+            pass
+    log_action(chat_id, user_id, "deleted", f"flood:{len(ids)}")
+    await warn_user(context, chat_id, user_id, reason=f"Flooding ({len(ids)} messages deleted)")
+
 # Message moderation filter
 async def message_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -187,23 +290,21 @@ async def message_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user and user.is_bot:
         return
 
-    # keep original text for caps check, lower-case for matching
-    raw_text = (msg.text or msg.caption or "") 
-    text = raw_text.lower()
+    # admins are already excluded by MODERATED_MESSAGES at dispatch
+    raw_text = (msg.text or msg.caption or "")
 
-    # Fetch settings with safe fallbacks
-    try:
-        antispam_setting = get_setting(chat_id, "antispam", None)
-    except Exception:
-        antispam_setting = None
-    try:
-        block_links_setting = get_setting(chat_id, "block_links", None)
-    except Exception:
-        block_links_setting = None
-    try:
-        flood_setting = get_setting(chat_id, "flood_limit", None)
-    except Exception:
-        flood_setting = None
+    # Fetch settings and filters with safe fallbacks; on a cache miss both
+    # queries are in flight at once instead of back to back
+    settings, filters_list = await asyncio.gather(
+        get_settings(chat_id), get_filters(chat_id), return_exceptions=True
+    )
+    if isinstance(settings, Exception):
+        settings = {}
+    if isinstance(filters_list, Exception):
+        filters_list = ()
+    antispam_setting = settings.get("antispam")
+    block_links_setting = settings.get("block_links")
+    flood_setting = settings.get("flood_limit")
 
     try:
         antispam = int(antispam_setting) if antispam_setting is not None else 1
@@ -222,45 +323,46 @@ async def message_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
             flood_limit = FLOOD_LIMIT
 
     # flood
-    if check_flood(chat_id, user.id, flood_limit):
+    if await check_flood(chat_id, user.id, flood_limit):
+        key = (chat_id, user.id)
+        pending = _flood_pending.get(key)
+        if pending is not None:
+            pending.append(msg.message_id)
+        else:
+            _flood_pending[key] = [msg.message_id]
+            context.application.create_task(flush_flood(context, chat_id, user.id))
+        return
+
+    # links
+    if block_links and has_link(msg):
         try:
             await msg.delete()
         except Exception:
             pass
-        log_action(chat_id, user.id, "deleted", "flood")
-        await warn_user(context, chat_id, user.id, reason="Flooding")
+        log_action(chat_id, user.id, "deleted", "link")
+        await warn_user(context, chat_id, user.id, reason="Posting links")
         return
 
-    # links
-    if block_links and URL_REGEX.search(text):
-        if user.id not in ADMIN_IDS:
-            try:
-                await msg.delete()
-            except Exception:
-                pass
-            log_action(chat_id, user.id, "deleted", "link")
-            await warn_user(context, chat_id, user.id, reason="Posting links")
-            return
-
     # bad words
-    try:
-        filters_list = get_filters(chat_id) or []
-    except Exception:
-        filters_list = []
     if not filters_list:
         filters_list = DEFAULT_BADWORDS
-    for w in filters_list:
-        if w and w in text:
-            try:
-                await msg.delete()
-            except Exception:
-                pass
-            log_action(chat_id, user.id, "deleted", f"badword:{w}")
-            await warn_user(context, chat_id, user.id, reason=f"Use of banned word: {w}")
-            return
+    # case-fold once, only now that flood/link checks didn't already act
+    text = raw_text.casefold()
+    automaton = badword_automaton(filters_list)
+    hit = next(automaton.iter(text), None) if automaton else None
+    if hit:
+        w = hit[1]
+        try:
+            await msg.delete()
+        except Exception:
+            pass
+        log_action(chat_id, user.id, "deleted", f"badword:{w}")
+        await warn_user(context, chat_id, user.id, reason=f"Use of banned word: {w}")
+        return
 
-    # caps spam heuristic (use raw_text so uppercase check works)
-    if raw_text and sum(1 for c in raw_text if c.isupper()) > 25 and len(raw_text) < 400:
+    # caps spam heuristic (use raw_text so uppercase check works); the length
+    # bounds are checked first so most messages never get counted at all
+    if 25 < len(raw_text) < 400 and count_upper(raw_text) > 25:
         try:
             await msg.delete()
         except Exception:
@@ -270,21 +372,25 @@ async def message_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 # Admin commands
-@admin_only
 async def addfilter_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if not context.args:
-        await update.effective_message.reply_text("Usage: /addfilter <word>")
+    # "/addfilter a, b, c" adds several words with one bulk write
+    words = [w.strip().lower() for w in " ".join(context.args).split(",")]
+    words = [w for w in words if w]
+    if not words:
+        await update.effective_message.reply_text("Usage: /addfilter <word>[, <word>...]")
         return
-    word = " ".join(context.args).strip().lower()
     try:
-        add_filter(chat_id, word)
-        await update.effective_message.reply_text(f"Added filter: {word}")
+        if len(words) == 1:
+            await add_filter(chat_id, words[0])
+            await update.effective_message.reply_text(f"Added filter: {words[0]}")
+        else:
+            await add_filters_bulk(chat_id, words)
+            await update.effective_message.reply_text(f"Added {len(words)} filters: " + ", ".join(words))
     except Exception:
         logger.exception("Failed to add filter")
         await update.effective_message.reply_text("Failed to add filter due to internal error.")
 
-@admin_only
 async def delfilter_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if not context.args:
@@ -292,25 +398,23 @@ async def delfilter_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     word = " ".join(context.args).strip().lower()
     try:
-        remove_filter(chat_id, word)
+        await remove_filter(chat_id, word)
         await update.effective_message.reply_text(f"Removed filter: {word}")
     except Exception:
         logger.exception("Failed to remove filter")
         await update.effective_message.reply_text("Failed to remove filter due to internal error.")
 
-@admin_only
 async def listfilters_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        words = get_filters(chat_id)
+        words = await get_filters(chat_id)
     except Exception:
         words = []
     if not words:
         await update.effective_message.reply_text("No filters set.")
     else:
-        await update.effective_message.reply_text("Filters:\n" + "\n".join(words))
+        await update.effective_message.reply_text("Filters:\n" + "\n".join(sorted(words)))
 
-@admin_only
 async def warn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if update.message.reply_to_message:
@@ -328,7 +432,6 @@ async def warn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await warn_user(context, chat_id, target, reason)
 
-@admin_only
 async def unwarn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if update.message.reply_to_message:
@@ -343,13 +446,12 @@ async def unwarn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Usage: reply to user or /unwarn <user_id>")
         return
     try:
-        reset_warn(chat_id, target)
+        await reset_warn(chat_id, target)
         await update.effective_message.reply_text("Warnings reset.")
     except Exception:
         logger.exception("Failed to reset warns")
         await update.effective_message.reply_text("Failed to reset warns due to internal error.")
 
-@admin_only
 async def set_warn_limit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global WARN_LIMIT
     if not context.args:
@@ -362,31 +464,72 @@ async def set_warn_limit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.effective_message.reply_text("Invalid number.")
 
 # Build and run application
+# Only the update types we have handlers for; Telegram won't send the rest
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+
+async def post_init(application):
+    try:
+        await init_db()
+    except Exception:
+        logger.exception("Could not reach MongoDB at startup")
+    # Background writer for queued log_action rows. Plain asyncio tasks:
+    # the application isn't running yet, and post_shutdown stops them itself.
+    application.bot_data["log_flusher"] = asyncio.create_task(run_log_flusher())
+    application.bot_data["cache_watcher"] = asyncio.create_task(watch_cache_invalidations())
+
+async def post_shutdown(application):
+    watcher = application.bot_data.pop("cache_watcher", None)
+    if watcher is not None:
+        watcher.cancel()
+    flusher = application.bot_data.pop("log_flusher", None)
+    if flusher is not None:
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+    await flush_logs()
+    close_db()
+    if _redis is not None:
+        await _redis.aclose()
+
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # faster event loop for PTB's many small network awaits
+    if uvloop is not None and sys.platform != "win32":
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
 
     # Command handlers
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("addfilter", addfilter_cmd))
-    app.add_handler(CommandHandler("delfilter", delfilter_cmd))
-    app.add_handler(CommandHandler("listfilters", listfilters_cmd))
-    app.add_handler(CommandHandler("warn", warn_cmd))
-    app.add_handler(CommandHandler("unwarn", unwarn_cmd))
-    app.add_handler(CommandHandler("setwarnlimit", set_warn_limit_cmd))
+    app.add_handler(CommandHandler("addfilter", addfilter_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler("delfilter", delfilter_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler("listfilters", listfilters_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler("warn", warn_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler("unwarn", unwarn_cmd, filters=ADMIN_FILTER))
+    app.add_handler(CommandHandler("setwarnlimit", set_warn_limit_cmd, filters=ADMIN_FILTER))
+
+    # Flood tracker cleanup
+    app.job_queue.run_repeating(flood_sweep, interval=30)
 
     # Chat member and callbacks
     app.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
     app.add_handler(CallbackQueryHandler(captcha_click, pattern=r"^captcha:"))
 
-    # Message moderation (all non-status updates)
-    app.add_handler(MessageHandler(filters.ALL & (~filters.StatusUpdate.ALL), message_filter))
+    # Message moderation (only what message_filter inspects; admins are exempt)
+    app.add_handler(MessageHandler(MODERATED_MESSAGES, message_filter))
 
     if USE_WEBHOOK and WEBHOOK_URL:
-        logger.info("Webhook mode requested but webhook setup not implemented in this snippet.")
+        logger.info("Starting webhook on port %d...", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True
+        )
     else:
         logger.info("Starting polling...")
-        app.run_polling()
+        app.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
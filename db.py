@@ -1,72 +1,321 @@
 # db.py
 import os
 import time
-from pymongo import MongoClient
+import asyncio
+import logging
+import bson
+from datetime import datetime, timezone
+from collections import OrderedDict
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, OperationFailure
 
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME", "telegrambot")
+# Moderation logs are removed by MongoDB's TTL monitor after this long;
+# changing it updates the existing index at the next startup
+LOG_TTL_SECONDS = int(os.getenv("LOG_TTL_SECONDS", str(30 * 24 * 3600)))
 
 if not MONGO_URI:
     raise RuntimeError("MONGO_URI environment variable not set")
 
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
+# Pool sized for the bot, not a web app: PTB processes updates one at a time
+# by default, so in-flight ops are that handler plus the log flusher, the
+# change stream and deferred flood warnings. Keep a few warm sockets so
+# bursts don't pay TCP/TLS handshakes, and let idle ones go after 5 min.
+_CLIENT_OPTIONS = dict(
+    maxPoolSize=20,
+    minPoolSize=5,
+    maxIdleTimeMS=300000,
+    maxConnecting=4,
+    retryWrites=True,
+    # negotiated with the server; falls back to uncompressed if unsupported
+    compressors="zstd,zlib",
+    zlibCompressionLevel=3
+)
 
-warnings_col = db["warnings"]
-filters_col = db["filters"]
-settings_col = db["settings"]
-logs_col = db["logs"]
+# The client is created on first use, from inside the running loop: importing
+# db.py does no DNS/TCP work, and Motor is bound to the loop PTB actually runs
+# instead of whatever loop existed at import time.
+_client = None
+_cols = {}  # {name: collection handle}, filled together with _client
+
+def _get_db():
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(MONGO_URI, io_loop=asyncio.get_running_loop(), **_CLIENT_OPTIONS)
+        db = _client[DB_NAME]
+        for name in ("warnings", "filters", "settings", "logs"):
+            _cols[name] = db[name]
+        # Fire-and-forget handle for the log flusher: audit rows are not critical,
+        # so w=0 skips the server ack (rows in flight can be lost on a crash).
+        # warnings/settings/filters keep the default acknowledged writes.
+        _cols["logs_fast"] = _cols["logs"].with_options(write_concern=WriteConcern(w=0))
+    return _client[DB_NAME]
+
+def _col(name):
+    if _client is None:
+        _get_db()
+    return _cols[name]
+
+# Closes the client at shutdown; the next use opens a fresh one on the
+# then-running loop.
+def close_db():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+        _cols.clear()
+
+logger = logging.getLogger(__name__)
+
+# Every lookup below filters on these keys, so each one is an index seek;
+# the unique ones also let upserts match a single document directly.
+_INDEXES = [
+    ("warnings", [("chat_id", 1), ("user_id", 1)], {"unique": True}),
+    ("filters", [("chat_id", 1), ("word", 1)], {"unique": True}),
+    ("settings", [("chat_id", 1)], {"unique": True}),
+    # ObjectIds grow with insert time, so _id orders a chat's logs by time;
+    # timestamp is kept only as the Date the TTL index needs
+    ("logs", [("chat_id", 1), ("_id", -1)], {}),
+    ("logs", [("timestamp", 1)], {"expireAfterSeconds": LOG_TTL_SECONDS}),
+]
+
+# Called once at startup: opens the client's pool so the first moderated
+# message doesn't pay the connection handshake, and makes sure the indexes
+# above exist. A failing index (e.g. duplicates left in an old collection)
+# is logged and doesn't stop the others.
+async def init_db():
+    # every read and write goes through the BSON codec; the pure-Python
+    # fallback is several times slower (usually a source build of pymongo)
+    if not bson.has_c():
+        logger.warning("bson C extension not available; install a pymongo wheel for faster encoding")
+    await _get_db().client.admin.command("ping")
+    for name, keys, opts in _INDEXES:
+        try:
+            try:
+                await _col(name).create_index(keys, **opts)
+            except OperationFailure as e:
+                # IndexOptionsConflict: the TTL index exists with an older
+                # LOG_TTL_SECONDS, so change its expiry in place
+                if e.code != 85 or "expireAfterSeconds" not in opts:
+                    raise
+                await _get_db().command("collMod", name, index={
+                    "keyPattern": dict(keys),
+                    "expireAfterSeconds": opts["expireAfterSeconds"],
+                })
+        except Exception:
+            logger.exception("Could not create index %s on %s", keys, name)
+
+# Bounded LRU caches for per-chat settings/filters; both are read on every
+# message but only change through the setters below, which invalidate them.
+# Entries also expire after CACHE_TTL seconds so writes made by another bot
+# process are picked up.
+CACHE_MAXSIZE = 4096
+CACHE_TTL = 60
+_settings_cache = OrderedDict()  # {chat_id: (expires_at, settings doc)}
+_filters_cache = OrderedDict()   # {chat_id: (expires_at, frozenset of words)}
+
+def _cache_get(cache, key):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return entry[1]
+
+def _cache_put(cache, key, value):
+    cache[key] = (time.monotonic() + CACHE_TTL, value)
+    cache.move_to_end(key)
+    if len(cache) > CACHE_MAXSIZE:
+        cache.popitem(last=False)
+
+# Change-stream invalidation: drop a chat's cached filters/settings as soon
+# as any process (or a manual edit) changes them. Needs a replica set; on a
+# standalone server the stream is refused and CACHE_TTL expiry is the fallback.
+_WATCHED = {"filters": _filters_cache, "settings": _settings_cache}
+_WATCH_PIPELINE = [{"$match": {
+    "ns.coll": {"$in": list(_WATCHED)},
+    "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+}}]
+
+# Server is a standalone, not a replica set: streams will never work here
+_STREAMS_UNSUPPORTED = (40573,)
+
+def _invalidate(change):
+    cache = _WATCHED[change["ns"]["coll"]]
+    chat_id = (change.get("fullDocument") or {}).get("chat_id")
+    if chat_id is None:
+        # Deletes only carry the _id, so we can't tell which chat changed and
+        # every chat misses once. remove_filter already pops its own chat;
+        # this clear is for deletes made by other processes or by hand.
+        # Pre-images would name the chat but need MongoDB 6.0 and a
+        # collection option, which isn't worth it for rare deletes.
+        cache.clear()
+    else:
+        cache.pop(chat_id, None)
+
+async def watch_cache_invalidations():
+    while True:
+        try:
+            async with _get_db().watch(_WATCH_PIPELINE, full_document="updateLookup") as stream:
+                async for change in stream:
+                    _invalidate(change)
+        except OperationFailure as e:
+            if e.code in _STREAMS_UNSUPPORTED:
+                logger.info("Change streams unavailable (%s); relying on %ds cache TTL", e, CACHE_TTL)
+                return
+            # auth, lost resume history etc.: transient or fixable, keep trying
+            logger.exception("Change stream failed, reopening")
+            await asyncio.sleep(5)
+        except Exception:
+            logger.exception("Change stream failed, reopening")
+            await asyncio.sleep(5)
+
+# Helpers take chat/user ids as the ints Telegram already provides and use
+# them as-is; callers convert user input (e.g. command args) themselves.
 
 # WARNINGS
-def get_warn_count(chat_id, user_id):
-    doc = warnings_col.find_one({"chat_id": int(chat_id), "user_id": int(user_id)})
-    return int(doc["count"]) if doc and "count" in doc else 0
-
-def set_warn_count(chat_id, user_id, count):
-    warnings_col.update_one(
-        {"chat_id": int(chat_id), "user_id": int(user_id)},
-        {"$set": {"count": int(count), "last_warn_ts": int(time.time())}},
-        upsert=True
+# Atomic read-modify-write for warnings: one round trip, and concurrent
+# warns can't overwrite each other the way a separate read and write can.
+# Written as an update pipeline so the server stamps last_warn_ts ($$NOW).
+async def increment_warn(chat_id, user_id, delta=1):
+    doc = await _col("warnings").find_one_and_update(
+        {"chat_id": chat_id, "user_id": user_id},
+        [{"$set": {"count": {"$add": [{"$ifNull": ["$count", 0]}, delta]}, "last_warn_ts": "$$NOW"}}],
+        projection={"count": 1, "_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    return int(doc["count"])
 
-def reset_warn(chat_id, user_id):
-    warnings_col.delete_one({"chat_id": int(chat_id), "user_id": int(user_id)})
+async def reset_warn(chat_id, user_id):
+    await _col("warnings").delete_one({"chat_id": chat_id, "user_id": user_id})
 
 # FILTERS
-def add_filter(chat_id, word):
-    filters_col.update_one(
-        {"chat_id": int(chat_id), "word": word},
-        {"$set": {"chat_id": int(chat_id), "word": word}},
+async def add_filter(chat_id, word):
+    await _col("filters").update_one(
+        {"chat_id": chat_id, "word": word},
+        {"$setOnInsert": {"chat_id": chat_id, "word": word}},
         upsert=True
     )
+    _filters_cache.pop(chat_id, None)
+
+# One unordered bulk write for many words; $setOnInsert leaves existing
+# filters untouched, and duplicate-key races on the unique index are ignored.
+async def add_filters_bulk(chat_id, words):
+    ops = [
+        UpdateOne({"chat_id": chat_id, "word": w}, {"$setOnInsert": {"chat_id": chat_id, "word": w}}, upsert=True)
+        for w in set(words)
+    ]
+    try:
+        if ops:
+            await _col("filters").bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    finally:
+        _filters_cache.pop(chat_id, None)
 
-def remove_filter(chat_id, word):
-    filters_col.delete_one({"chat_id": int(chat_id), "word": word})
+async def remove_filter(chat_id, word):
+    await _col("filters").delete_one({"chat_id": chat_id, "word": word})
+    _filters_cache.pop(chat_id, None)
 
-def get_filters(chat_id):
-    docs = filters_col.find({"chat_id": int(chat_id)})
-    return [d["word"] for d in docs] if docs else []
+# Large enough that a chat's whole filter list comes back in the first
+# batch instead of 101 docs plus getMore round trips.
+FILTERS_BATCH_SIZE = 1000
+
+async def get_filters(chat_id):
+    words = _cache_get(_filters_cache, chat_id)
+    if words is None:
+        cursor = _col("filters").find({"chat_id": chat_id}, {"word": 1, "_id": 0}, batch_size=FILTERS_BATCH_SIZE)
+        words = frozenset([d["word"] async for d in cursor])
+        _cache_put(_filters_cache, chat_id, words)
+    return words
 
 # SETTINGS
-def get_setting(chat_id, key, default=None):
-    doc = settings_col.find_one({"chat_id": int(chat_id)})
-    if doc and key in doc:
+# Only these keys may be read or written; the settings document is always
+# loaded with the same fixed projection.
+SETTINGS_KEYS = ("antispam", "block_links", "flood_limit")
+_SETTINGS_PROJECTION = {"_id": 0, **dict.fromkeys(SETTINGS_KEYS, 1)}
+
+def _check_setting_key(key):
+    if key not in SETTINGS_KEYS:
+        raise ValueError(f"Unknown setting: {key!r}")
+
+async def _get_settings_doc(chat_id):
+    doc = _cache_get(_settings_cache, chat_id)
+    if doc is None:
+        doc = await _col("settings").find_one({"chat_id": chat_id}, _SETTINGS_PROJECTION) or {}
+        _cache_put(_settings_cache, chat_id, doc)
+    return doc
+
+async def get_settings(chat_id):
+    return await _get_settings_doc(chat_id)
+
+async def get_setting(chat_id, key, default=None):
+    _check_setting_key(key)
+    doc = await _get_settings_doc(chat_id)
+    if key in doc:
         return doc[key]
     return default
 
-def set_setting(chat_id, key, value):
-    settings_col.update_one(
-        {"chat_id": int(chat_id)},
+async def set_setting(chat_id, key, value):
+    _check_setting_key(key)
+    await _col("settings").update_one(
+        {"chat_id": chat_id},
         {"$set": {key: value}},
         upsert=True
     )
+    _settings_cache.pop(chat_id, None)
 
 # LOGS
+# Log rows are queued and written in batches by run_log_flusher(), so a
+# burst of moderation actions costs one insert_many instead of one insert each.
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 0.5
+_log_queue = asyncio.Queue()
+
 def log_action(chat_id, user_id, action, reason=""):
-    logs_col.insert_one({
-        "chat_id": int(chat_id),
-        "user_id": int(user_id) if user_id is not None else None,
+    _log_queue.put_nowait({
+        "chat_id": chat_id,
+        "user_id": user_id,
         "action": action,
         "reason": reason,
-        "timestamp": int(time.time())
+        "timestamp": datetime.now(timezone.utc)
     })
+
+async def _write_logs(batch):
+    try:
+        await _col("logs_fast").insert_many(batch, ordered=False)
+    except Exception:
+        logger.exception("Failed to write %d log entries", len(batch))
+
+async def run_log_flusher():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _log_queue.get()]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        try:
+            while len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_log_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # still written if the flusher is cancelled mid-batch at shutdown
+            await _write_logs(batch)
+
+# Called on shutdown after the flusher is cancelled: writes whatever is
+# still queued so no log rows are lost on restart.
+async def flush_logs():
+    while not _log_queue.empty():
+        batch = []
+        while len(batch) < LOG_BATCH_SIZE and not _log_queue.empty():
+            batch.append(_log_queue.get_nowait())
+        await _write_logs(batch)